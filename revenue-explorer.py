@@ -1,22 +1,103 @@
 import streamlit as st
 import pandas as pd
 import altair as alt
-from urllib.request import Request, urlopen
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.dataset as ds
+import requests
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+
+# Local Parquet copies of the large datasets are rebuilt once a day
+parquet_cache_ttl = 24 * 3600
 
 # -----------------------------
 # Data Loading Module
 # -----------------------------
 
+@st.cache_resource
+def get_http_session():
+    # One pooled session, so repeated downloads reuse connections instead of new TCP and TLS handshakes
+    session = requests.Session()
+    session.headers['User-Agent'] = 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:77.0) Gecko/20100101 Firefox/77.0'
+    return session
+
+def read_csv(session, url):
+    response = session.get(url)
+    response.raise_for_status()
+    table = pv.read_csv(
+        BytesIO(response.content),
+        parse_options=pv.ParseOptions(invalid_row_handler=lambda row: 'skip', newlines_in_values=True),
+        # Keep dates as text so the year can still be sliced from the 'start_date' index
+        convert_options=pv.ConvertOptions(
+            column_types={'start_date': pa.string(), 'end_date': pa.string()},
+            strings_can_be_null=True
+        )
+    )
+    dataframe = table.to_pandas().drop(columns=['rowid'], errors='ignore')
+    # Low-cardinality text columns are grouped and filtered on, so store them as integer codes
+    for column in ('country', 'country_or_area_name', 'revenue_stream_name', 'company_type'):
+        if column in dataframe.columns:
+            dataframe[column] = dataframe[column].astype('category')
+    return dataframe
+
 @st.cache_data
 def load_data(url):
-    req = Request(url)
-    req.add_header('User-Agent', 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:77.0) Gecko/20100101 Firefox/77.0')
-    content = urlopen(req)
-    return pd.read_csv(content, on_bad_lines='skip').drop(columns=['rowid'], errors='ignore')
+    return read_csv(get_http_session(), url)
 
 def set_index(dataframe, column):
     dataframe.set_index(column, inplace=True)
 
+@st.cache_resource
+def split_by_country(url, column):
+    dataset = load_data(url)
+    set_index(dataset, 'start_date')
+    return {country: rows for country, rows in dataset.groupby(column, sort=False, observed=True)}
+
+def cache_as_parquet(session, url, name):
+    # Download and convert the dataset once, partitioned by country so reads can skip other countries
+    path = parquet_cache_dir / f'{name}.parquet'
+    if path.exists() and time.time() - path.stat().st_mtime < parquet_cache_ttl:
+        return path
+    # Convert into a fresh directory of our own, then swap it into place
+    partial_path = Path(tempfile.mkdtemp(dir=parquet_cache_dir))
+    read_csv(session, url).to_parquet(partial_path, partition_cols=['country'], index=False)
+    if path.exists():
+        expired_path = Path(tempfile.mkdtemp(dir=parquet_cache_dir))
+        try:
+            path.rename(expired_path / path.name)
+        except FileNotFoundError:
+            pass  # Already replaced by another process
+        shutil.rmtree(expired_path)
+    try:
+        partial_path.rename(path)
+    except OSError:
+        # Another process put a fresh copy in place first
+        shutil.rmtree(partial_path)
+    return path
+
+@st.cache_resource(ttl=parquet_cache_ttl)
+def cache_large_datasets():
+    # Runs once for all sessions; the downloads overlap in a thread pool
+    session = get_http_session()
+    with ThreadPoolExecutor() as executor:
+        conversions = [executor.submit(cache_as_parquet, session, url, name) for name, url in large_dataset_urls.items()]
+        return [conversion.result() for conversion in conversions]
+
+@st.cache_data(ttl=parquet_cache_ttl)
+def load_country_data(name, country):
+    dataset = ds.dataset(parquet_cache_dir / f'{name}.parquet', partitioning='hive')
+    dataframe = dataset.to_table(filter=ds.field('country') == country).to_pandas()
+    # Partitioning moves 'country' to the end; restore the column order of the original CSV
+    column_order = [column['name'] for column in dataset.schema.pandas_metadata['columns']]
+    dataframe = dataframe[[column for column in column_order if column in dataframe.columns]]
+    set_index(dataframe, 'start_date')
+    return dataframe
+
 # URLs to datasets
 about_url = 'https://soe-database.eiti.org/eiti_database/about.csv?_size=max'
 agencies_url = 'https://soe-database.eiti.org/eiti_database/agencies.csv?_size=max'
@@ -24,18 +105,21 @@ companies_url = 'https://soe-database.eiti.org/eiti_database/companies.csv?_size
 projects_url = 'https://soe-database.eiti.org/eiti_database/projects.csv?_size=max'
 countries_svg_url = 'https://raw.githubusercontent.com/clombion/streamlit-test/main/countries_svg.csv'
 
-# Load datasets
+# Local Parquet copies of the large datasets, read one country at a time
+parquet_cache_dir = Path('parquet_cache')
+parquet_cache_dir.mkdir(exist_ok=True)
+large_dataset_urls = {'agencies': agencies_url, 'companies': companies_url, 'projects': projects_url}
+
+# Cache the large datasets as Parquet, then load the datasets needed before a country is selected
+cache_large_datasets()
 about = load_data(about_url)
-agencies = load_data(agencies_url)
-companies = load_data(companies_url)
-projects = load_data(projects_url)
 countries_svg = load_data(countries_svg_url)
 
-# Set the year as the index for all datasets
+# Set the year as the index
 set_index(about, 'start_date')
-set_index(agencies, 'start_date')
-set_index(companies, 'start_date')
-set_index(projects, 'start_date')
+
+# Split the metadata by country once, so selecting a country is a lookup instead of a full scan
+about_by_country = split_by_country(about_url, 'country_or_area_name')
 
 # -----------------------------
 # Styling Module
@@ -160,10 +244,10 @@ def display_country_svg(selected_country):
 
 def display_country_report(selected_country):
     # Filter data for selected country
-    country_data = about[about['country_or_area_name'] == selected_country]
-    country_agencies = agencies[agencies['country'] == selected_country]
-    country_companies = companies[companies['country'] == selected_country]
-    country_projects = projects[projects['country'] == selected_country]
+    country_data = about_by_country.get(selected_country, about.iloc[:0])
+    country_agencies = load_country_data('agencies', selected_country)
+    country_companies = load_country_data('companies', selected_country)
+    country_projects = load_country_data('projects', selected_country)
 
     # Count unique companies and projects
     unique_companies = country_companies.drop_duplicates(subset='eiti_id_company').shape[0]
@@ -180,7 +264,12 @@ def display_country_report(selected_country):
     else:
         total_revenue_str = f"{total_revenue / 1e6:.2f} million"
 
-    top_3_revenue_streams = country_agencies.groupby('revenue_stream_name')['revenue_value'].sum().sort_values(ascending=False).head(3).index.tolist()
+    # Group revenue by year and stream once; the top 3, the chart and the CSV summary all reuse it
+    report_years = country_agencies.index.str[:4]
+    revenue_by_year_stream = country_agencies.groupby([report_years, 'revenue_stream_name'], dropna=False, observed=True)['revenue_value'].sum()
+    revenue_streams = revenue_by_year_stream.groupby(level=1, observed=True).sum().sort_values(ascending=False)
+
+    top_3_revenue_streams = revenue_streams.nlargest(3).index.tolist()
     top_3_revenue_streams_str = ", ".join(top_3_revenue_streams)
 
     # Display the sentence after the main title
@@ -199,13 +288,12 @@ def display_country_report(selected_country):
 
     # Visualization for revenue streams using Altair
     st.markdown(f'<h2 class="section-title">Revenue between {earliest_year} and {latest_year}</h2>', unsafe_allow_html=True)
-    revenue_streams = country_agencies.groupby('revenue_stream_name')['revenue_value'].sum().sort_values(ascending=False) / 1e6
-
-    revenue_df = revenue_streams.reset_index()
+    # revenue_streams is already sorted, so only the largest bars are sent and Vega-Lite need not re-sort them
+    revenue_df = (revenue_streams.head(25) / 1e6).reset_index()
     revenue_df.columns = ['Revenue Stream', 'Revenue (Million USD)']
 
     chart = alt.Chart(revenue_df).mark_bar().encode(
-        x=alt.X('Revenue Stream', sort='-y'),
+        x=alt.X('Revenue Stream:N', sort=None),
         y=alt.Y('Revenue (Million USD)', title='Revenue (Million USD)'),
         tooltip=['Revenue Stream', 'Revenue (Million USD)']
     ).properties(
@@ -216,7 +304,7 @@ def display_country_report(selected_country):
     st.markdown('<div class="section-space"></div>', unsafe_allow_html=True)
 
     # Calculate revenue breakdown by company type
-    company_type_revenue = country_companies.groupby('company_type')['revenue_value'].sum().reset_index()
+    company_type_revenue = country_companies.groupby('company_type', observed=True)['revenue_value'].sum().reset_index()
     company_type_revenue['Percentage'] = (company_type_revenue['revenue_value'] / company_type_revenue['revenue_value'].sum()) * 100
 
     # Filter unique projects by company type
@@ -337,23 +425,24 @@ def display_country_report(selected_country):
     with st.expander("Metadata"):
         st.write(country_data)
 
-    # Create CSV summary data
-    summary_data = []
-    for year in range(int(earliest_year), int(latest_year) + 1):
-        year_data = country_agencies[country_agencies.index.str.startswith(str(year))]
-        year_revenue = year_data['revenue_value'].sum()
-        top_3_year_revenue_streams = year_data.groupby('revenue_stream_name')['revenue_value'].sum().sort_values(ascending=False).head(3).index.tolist()
-        top_3_year_revenue_streams_str = ", ".join(top_3_year_revenue_streams)
-        summary_data.append({
-            'Country': selected_country,
-            'Year': year,
-            'Reporting Companies': unique_companies,
-            'Projects': unique_projects,
-            'Revenue': year_revenue,
-            'Top 3 Revenue Streams': top_3_year_revenue_streams_str
-        })
-
-    summary_df = pd.DataFrame(summary_data)
+    # Create CSV summary data, with a row for every year of the reporting period
+    summary_years = range(int(earliest_year), int(latest_year) + 1)
+    summary_year_keys = [str(year) for year in summary_years]
+    yearly_revenue = revenue_by_year_stream.groupby(level=0).sum().reindex(summary_year_keys, fill_value=0)
+
+    named_streams = revenue_by_year_stream[revenue_by_year_stream.index.get_level_values(1).notna()]
+    top_3_yearly = named_streams.sort_values(ascending=False).groupby(level=0).head(3)
+    top_3_yearly_names = pd.Series(top_3_yearly.index.get_level_values(1).astype(str), index=top_3_yearly.index.get_level_values(0))
+    top_3_yearly_str = top_3_yearly_names.groupby(level=0).agg(", ".join).reindex(summary_year_keys, fill_value="")
+
+    summary_df = pd.DataFrame({
+        'Country': selected_country,
+        'Year': list(summary_years),
+        'Reporting Companies': unique_companies,
+        'Projects': unique_projects,
+        'Revenue': yearly_revenue.to_numpy(),
+        'Top 3 Revenue Streams': top_3_yearly_str.to_numpy()
+    })
 
     # Downloadable link for CSV
     st.markdown('<h2 class="section-title">Download Summary Data</h2>', unsafe_allow_html=True)
@@ -1,121 +1,223 @@
 import streamlit as st
 import pandas as pd
 import altair as alt
-import numpy as np
+import pyarrow as pa
 import re
+import time
+from html import escape
+from pathlib import Path
+from urllib.parse import quote
+
+# Slices of the cached data share its memory until written to, instead of being defensively copied.
+# pandas 3 always does this and deprecates the option.
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.options.mode.copy_on_write = True
+
+# Text within parentheses, compiled once and reused for every commodities column.
+# It never spans a line break or a NUL, so rows joined by NUL are matched one by one.
+_PAREN_RE = re.compile(r'\s*\([^)\n\x00]*\)\s*')
+
+# Local Parquet copy of the Datasette export, refreshed once a day
+_CACHE_PATH = Path('eiti_cache.parquet')
+_CACHE_TTL = 24 * 3600
 
 # -----------------------------
 # Helper Functions Module
 # -----------------------------
 
-@st.cache_data
-def get_data():
+def read_dataset():
     """
-    Load and cache data from the Datasette API.
+    Read the data from the local Parquet copy, or from the Datasette API.
+    
+    A local Parquet copy younger than a day is read instead of the API when
+    available, so a fresh process skips the download and CSV parsing.
     
     Returns:
         pd.DataFrame: DataFrame containing the loaded data.
     """
-    return pd.read_csv("http://35.228.140.89/eiti_database.csv?sql=SELECT%0D%0A++++scra.*%2C%0D%0A++++REPLACE%28REPLACE%28ca.commodities%2C+%27n%2Fa%27%2C+%27%27%29%2C+%27n%2Fv%27%2C+%27%27%29+AS+commodities%0D%0AFROM%0D%0A++++soe_companies_revenue_annual+AS+scra%0D%0ALEFT+JOIN+%28%0D%0A++++SELECT%0D%0A++++++++dc.eiti_id_company+AS+eiti_id_declaration%2C%0D%0A++++++++dc.year%2C%0D%0A++++++++GROUP_CONCAT%28DISTINCT+dp.commodities%29+AS+commodities%0D%0A++++FROM%0D%0A++++++++declaration_companies+AS+dc%0D%0A++++JOIN%0D%0A++++++++declaration_projects+AS+dp%0D%0A++++ON%0D%0A++++++++dc.eiti_id_project+%3D+dp.eiti_id_project%0D%0A++++GROUP+BY%0D%0A++++++++dc.eiti_id_company%2C%0D%0A++++++++dc.year%0D%0A%29+AS+ca%0D%0AON%0D%0A++++scra.eiti_id_company+%3D+ca.eiti_id_declaration%0D%0AAND%0D%0A++++scra.year+%3D+ca.year%3B%0D%0A&_size=max")
-
-def filter_data_by_company(data, company_name):
+    if _CACHE_PATH.exists() and time.time() - _CACHE_PATH.stat().st_mtime < _CACHE_TTL:
+        return pd.read_parquet(_CACHE_PATH)
+    data = pd.read_csv("http://35.228.140.89/eiti_database.csv?sql=SELECT%0D%0A++++scra.*%2C%0D%0A++++REPLACE%28REPLACE%28ca.commodities%2C+%27n%2Fa%27%2C+%27%27%29%2C+%27n%2Fv%27%2C+%27%27%29+AS+commodities%0D%0AFROM%0D%0A++++soe_companies_revenue_annual+AS+scra%0D%0ALEFT+JOIN+%28%0D%0A++++SELECT%0D%0A++++++++dc.eiti_id_company+AS+eiti_id_declaration%2C%0D%0A++++++++dc.year%2C%0D%0A++++++++GROUP_CONCAT%28DISTINCT+dp.commodities%29+AS+commodities%0D%0A++++FROM%0D%0A++++++++declaration_companies+AS+dc%0D%0A++++JOIN%0D%0A++++++++declaration_projects+AS+dp%0D%0A++++ON%0D%0A++++++++dc.eiti_id_project+%3D+dp.eiti_id_project%0D%0A++++GROUP+BY%0D%0A++++++++dc.eiti_id_company%2C%0D%0A++++++++dc.year%0D%0A%29+AS+ca%0D%0AON%0D%0A++++scra.eiti_id_company+%3D+ca.eiti_id_declaration%0D%0AAND%0D%0A++++scra.year+%3D+ca.year%3B%0D%0A&_size=max")
+    # Write to a temporary file first so a concurrent reader never sees a partial cache
+    partial_path = _CACHE_PATH.with_name(f'{_CACHE_PATH.name}.partial')
+    data.to_parquet(partial_path, compression='zstd')
+    partial_path.replace(_CACHE_PATH)
+    return data
+
+@st.cache_data(ttl=_CACHE_TTL)
+def get_data():
+    """
+    Load and cache the data along with row positions per company and country.
+    
+    Returns:
+        tuple: The DataFrame, and dicts mapping each company name and each
+        country to the positions of its rows.
+    """
+    data = read_dataset()
+    # Names are filtered and listed on every rerun, so store them as integer codes
+    data['company_name'] = data['company_name'].astype('category')
+    data['country'] = data['country'].astype('category')
+    # Revenue in millions for the chart, computed once instead of on every rerun
+    data['revenue_value_usd_million'] = data['revenue_value_usd'] / 1e6
+    company_rows = data.groupby('company_name', sort=False, observed=True).indices
+    country_rows = data.groupby('country', sort=False, observed=True).indices
+    return data, company_rows, country_rows
+
+def filter_data_by_company(data, company_rows, company_name):
     """
     Filter the data for a specific company.
     
     Args:
         data (pd.DataFrame): The original data.
+        company_rows (dict): Row positions for each company name.
         company_name (str): The name of the company to filter by.
     
     Returns:
         pd.DataFrame: Filtered data for the specified company.
     """
-    return data[data['company_name'] == company_name]
-
-def process_commodities(commodities):
-    processed = []
-    for item in commodities:
-        if pd.isna(item):
-            continue  # Skip NaN values
-        # Remove text within parentheses
-        item = re.sub(r'\s*\(.*?\)\s*', '', str(item))
-        processed.append(item.strip())
-    # If the list is empty or contains only NaNs, return 'unknown commodities'
-    if not processed:
-        return ['unknown commodities']
-    return processed
-
-def compute_company_info(filtered_data):
+    return data.iloc[company_rows.get(company_name, [])]
+
+def process_commodities(commodities, company_names):
     """
-    Compute company information such as the number of reports,
-    the earliest report year, and the latest report year.
+    Clean the comma-separated commodity lists into unique commodities per company.
     
     Args:
-        filtered_data (pd.DataFrame): The filtered data for a company.
+        commodities (pd.Series): The commodities column of the whole dataset.
+        company_names (pd.Series): The company name of each row.
     
     Returns:
-        dict: A dictionary containing company information.
+        dict: Sorted unique commodities keyed by company name. Companies
+        without any known commodity are left out.
     """
-    num_reports = len(filtered_data)
-    earliest_year = str(filtered_data['year'].min())
-    latest_year = str(filtered_data['year'].max())
-    total_revenue_usd = filtered_data['revenue_value_usd'].sum()
-    share_of_national_payments = filtered_data['percentage_country_usd'].mean()
+    known = commodities.notna().to_numpy()
+    if not known.any():
+        return {}
+    # Remove text within parentheses with a single regex pass over all rows joined by NUL
+    cleaned = _PAREN_RE.sub('', '\x00'.join(map(str, commodities.to_numpy()[known]))).split('\x00')
+
+    processed = {}
+    for company, entry in zip(company_names.to_numpy()[known], cleaned):
+        items = {item.strip() for item in entry.split(',')} - {''}
+        if items:
+            processed.setdefault(company, set()).update(items)
+    return {company: sorted(items) for company, items in processed.items()}
+
+@st.cache_resource(ttl=_CACHE_TTL)
+def build_summary():
+    """
+    Compute company information such as the number of reports,
+    the earliest report year, and the latest report year, for every
+    company at once. The result is shared rather than copied on each call,
+    so it must be treated as read-only.
     
-    # Ensure all entries in 'commodities' are lists
-    filtered_data['commodities'] = filtered_data['commodities'].apply(lambda x: x if isinstance(x, list) else [x])
-
-    # Replace arrays of NaNs with a single NaN
-    filtered_data['commodities'] = filtered_data['commodities'].apply(process_commodities)
+    Returns:
+        dict: Company information dictionaries keyed by company name.
+    """
+    data, _, _ = get_data()
+    summary = data.groupby('company_name', sort=False, observed=True).agg(
+        country=('country', 'first'),
+        num_reports=('year', 'size'),
+        earliest_year=('year', 'min'),
+        latest_year=('year', 'max'),
+        total_revenue_usd=('revenue_value_usd', 'sum'),
+        share_of_national_payments=('percentage_country_usd', 'mean')
+    )
+    commodities = process_commodities(data['commodities'], data['company_name'])
+    
+    return {
+        row.Index: {
+            'Name': row.Index,
+            'Country': row.country,
+            'Number of Reports': row.num_reports,
+            'Earliest Report Year': str(row.earliest_year),
+            'Latest Report Year': str(row.latest_year),
+            'Total Revenue USD': row.total_revenue_usd,
+            'Share of National Payments': row.share_of_national_payments,
+            # If no year reports a commodity, return 'unknown commodities'
+            'Commodities': commodities.get(row.Index, ['unknown commodities'])
+        }
+        for row in summary.itertuples()
+    }
 
-    # Combine and deduplicate arrays in 'commodities'
-    unique_commodities = list(set([item for sublist in filtered_data['commodities'] for item in sublist]))
+@st.cache_resource(ttl=_CACHE_TTL)
+def build_company_lists():
+    """
+    List the sidebar options: the countries, and the companies of each country.
+    The lists are shared rather than copied on each call, so they must be
+    treated as read-only.
     
-    company_info = {
-        'Name': filtered_data['company_name'].iloc[0],
-        'Country': filtered_data['country'].iloc[0],
-        'Number of Reports': num_reports,
-        'Earliest Report Year': earliest_year,
-        'Latest Report Year': latest_year,
-        'Total Revenue USD': total_revenue_usd,
-        'Share of National Payments': share_of_national_payments,
-        'Commodities': unique_commodities
+    Returns:
+        tuple: The country options starting with 'Global', a dict mapping
+        each country option to its company names, and a dict mapping each
+        country option to the position of every company name in its list.
+    """
+    data, _, country_rows = get_data()
+    countries = ['Global'] + data['country'].cat.categories.tolist()
+    companies_by_country = {'Global': data['company_name'].unique().tolist()}
+    for country, rows in country_rows.items():
+        companies_by_country[country] = data['company_name'].iloc[rows].unique().tolist()
+    company_positions = {
+        country: {name: i for i, name in enumerate(names)}
+        for country, names in companies_by_country.items()
     }
+    return countries, companies_by_country, company_positions
+
+@st.cache_data(ttl=_CACHE_TTL)
+def build_detailed_table(company_name):
+    """
+    Build the detailed data table for a company as an Arrow table, which
+    is the format Streamlit sends to the browser.
     
-    return company_info
+    Args:
+        company_name (str): The name of the company.
+    
+    Returns:
+        pa.Table: The company's rows indexed by year, without the columns
+        already shown elsewhere on the page.
+    """
+    data, company_rows, _ = get_data()
+    filtered_data = filter_data_by_company(data, company_rows, company_name)
+    filtered_data = filtered_data.drop(columns=['eiti_id_company', 'company_name', 'country'])
+    # Show each year's commodities without text within parentheses, as a one-item list
+    filtered_data = filtered_data.assign(commodities=[
+        [_PAREN_RE.sub('', str(item)).strip()] if known else ['unknown commodities']
+        for item, known in zip(filtered_data['commodities'], filtered_data['commodities'].notna())
+    ])
+    filtered_data = filtered_data.set_index('year')
+    return pa.Table.from_pandas(filtered_data, preserve_index=True)
 
-def render_other_companies(data, country, current_company):
+def render_other_companies(company_names, country, current_company, selected_country):
     """
     Render a list of other companies from the same country.
     
+    Each company is a link that reloads the page with its name in the
+    'company' query parameter and the sidebar country in the 'country'
+    query parameter, so the whole list is a single HTML block.
+    
     Args:
-        data (pd.DataFrame): The original data.
+        company_names (list): The company names of the country.
         country (str): The country name.
         current_company (str): The current company name.
+        selected_country (str): The country selected in the sidebar.
     """
-    other_companies = data[(data['country'] == country) & (data['company_name'] != current_company)]
-    if not other_companies.empty:
+    other_companies = [company for company in company_names if company != current_company]
+    if other_companies:
         st.markdown(f"<h3 class='other-soes-heading'>Other SOEs from {country}</h3>", unsafe_allow_html=True)
-        cols = st.columns(2)
-        companies = other_companies['company_name'].unique()
-        for i, company in enumerate(companies):
-            col = cols[i % 2]
-            if col.button(company):
-                st.session_state.temp_selected_company = company
-                st.experimental_rerun()
+        links = ''.join(
+            f"<a href='?country={quote(selected_country)}&company={quote(company)}' target='_self' class='button-as-link'>{escape(company)}</a>"
+            for company in other_companies
+        )
+        st.markdown(f"<div class='other-soes-grid'>{links}</div>", unsafe_allow_html=True)
 
 # -----------------------------
 # UI Functions Module
 # -----------------------------
 
-def render_company_info(company_info):
+def apply_custom_css():
     """
-    Render the company information as styled content in the Streamlit app.
-    
-    Args:
-        company_info (dict): A dictionary containing company information.
+    Inject the custom CSS used across the page.
     """
-    # Custom CSS for styling
-    custom_css = """
+    st.markdown("""
     <style>
     @import url('https://fonts.googleapis.com/css2?family=Montserrat:wght@400;700&family=Open+Sans:wght@400;700&family=Oswald:wght@400;700&display=swap');
     
@@ -176,44 +278,67 @@ def render_company_info(company_info):
     .button-as-link::before {
         content: '➜  ';
     }
+    .other-soes-grid {
+        display: grid;
+        grid-template-columns: repeat(2, 1fr);
+    }
     .other-soes-heading {
         margin-bottom: 20px;
     }
-    .stButton>button {
-        width: 80% !important;
-        text-align: left !important;
-        display: block;
-        margin: auto;
-        float:left;
-    }
     </style>
+    """, unsafe_allow_html=True)
+
+@st.cache_data(ttl=_CACHE_TTL)
+def build_company_sentence(company_name):
     """
+    Build the company information sentence for a company as styled HTML.
+    
+    Args:
+        company_name (str): The name of the company.
+    
+    Returns:
+        str: The HTML of the company information sentence.
+    """
+    company_info = build_summary()[company_name]
     commodities_str = ', '.join(company_info['Commodities'])
 
     # Company information sentence with styled variables
-    company_sentence = (
+    return (
         f"<div class='company-info'><strong>{company_info['Name']}</strong> is a state-owned enterprise from <strong>{company_info['Country']}</strong> dealing in <strong>{commodities_str}</strong>."
         f"The company paid a declared amount of <strong>{company_info['Total Revenue USD'] / 1e6:,.2f}</strong> million USD in taxes for its extractives activities "
         f"between <strong>{company_info['Earliest Report Year']}</strong> and <strong>{company_info['Latest Report Year']}</strong>, representing <strong>{company_info['Share of National Payments']}</strong>% of the sector's contribution to the national budget over that period..</div>"
     )
 
-    # Display the custom CSS and company information
-    st.markdown(custom_css + company_sentence, unsafe_allow_html=True)
+def render_company_info(company_name):
+    """
+    Render the company information as styled content in the Streamlit app.
+    
+    Args:
+        company_name (str): The name of the company.
+    """
+    # Display the company information
+    st.markdown(build_company_sentence(company_name), unsafe_allow_html=True)
 
 
-def render_revenue_chart(filtered_data):
+@st.cache_resource(ttl=_CACHE_TTL)
+def build_revenue_chart(company_name):
     """
-    Render the revenue chart in the Streamlit app.
+    Build the revenue chart for a company. The chart object is shared across
+    reruns and sessions rather than copied out of the cache each time.
     
     Args:
-        filtered_data (pd.DataFrame): The filtered data for a company.
+        company_name (str): The name of the company.
+    
+    Returns:
+        alt.Chart: The revenue over time line chart.
     """
-    st.write("### Revenue Over Time")
-    st.markdown("<div style='margin-bottom: 20px;'></div>", unsafe_allow_html=True)  # Add space between title and chart
+    data, company_rows, _ = get_data()
+    filtered_data = filter_data_by_company(data, company_rows, company_name)
 
-    filtered_data['revenue_value_usd_million'] = filtered_data['revenue_value_usd'] / 1e6
+    # Only the plotted columns are serialized for Vega-Lite, already in year order
+    chart_data = filtered_data[['year', 'revenue_value_usd_million']].sort_values('year')
 
-    chart = alt.Chart(filtered_data).mark_line(point=True).encode(
+    return alt.Chart(chart_data).mark_line(point=True).encode(
         x=alt.X('year:O', title='Year'),
         y=alt.Y('revenue_value_usd_million:Q', title='Revenue (Million USD)'),
         tooltip=[alt.Tooltip('revenue_value_usd_million:Q', title='Revenue (Million USD)')]
@@ -229,21 +354,29 @@ def render_revenue_chart(filtered_data):
         size=50
     )
 
-    st.altair_chart(chart, use_container_width=True)
+def render_revenue_chart(company_name):
+    """
+    Render the revenue chart in the Streamlit app.
+    
+    Args:
+        company_name (str): The name of the company.
+    """
+    st.write("### Revenue Over Time")
+    st.markdown("<div style='margin-bottom: 20px;'></div>", unsafe_allow_html=True)  # Add space between title and chart
 
-def render_detailed_data_table(filtered_data):
+    st.altair_chart(build_revenue_chart(company_name), use_container_width=True)
+
+def render_detailed_data_table(detailed_table):
     """
     Render the detailed data table in the Streamlit app.
     
     Args:
-        filtered_data (pd.DataFrame): The filtered data for a company.
+        detailed_table (pa.Table): The detailed data for a company.
     """
     st.write("### Detailed Data")
-    filtered_data = filtered_data.drop(columns=['eiti_id_company', 'company_name', 'country'])
-    filtered_data = filtered_data.set_index('year')
-    num_rows = len(filtered_data)
+    num_rows = detailed_table.num_rows
     table_height = 100 + num_rows * 25  # Adjust the multiplier and base height as needed
-    st.dataframe(filtered_data, height=table_height)
+    st.dataframe(detailed_table, height=table_height)
 
 # -----------------------------
 # Main Application Logic
@@ -256,20 +389,29 @@ def update_selected_company():
     st.session_state.selected_company = st.session_state.company_select
 
 def main():
+    # Apply custom CSS for styling
+    apply_custom_css()
+
     # Load data
-    data = get_data()
+    countries, companies_by_country, company_positions = build_company_lists()
 
     # Initialize session state for selected country and company if not already set
     if 'selected_country' not in st.session_state:
         st.session_state.selected_country = 'Global'
     if 'selected_company' not in st.session_state:
-        st.session_state.selected_company = data['company_name'].unique()[0]
-
-    # Handle button clicks to update selected company
-    if 'temp_selected_company' in st.session_state:
-        st.session_state.selected_company = st.session_state.temp_selected_company
-        del st.session_state['temp_selected_company']
-        st.experimental_rerun()
+        st.session_state.selected_company = companies_by_country['Global'][0]
+
+    # Handle clicks on the other companies' links to restore the sidebar country and update selected company
+    if 'country' in st.query_params:
+        linked_country = st.query_params['country']
+        del st.query_params['country']
+        if linked_country in companies_by_country:
+            st.session_state.selected_country = linked_country
+    if 'company' in st.query_params:
+        linked_company = st.query_params['company']
+        del st.query_params['company']
+        if linked_company in company_positions['Global']:
+            st.session_state.selected_company = linked_company
     
     st.sidebar.image("https://totalenergies.com/sites/g/files/nytnzq121/files/styles/w_1110/public/images/2022-04/Logo_EITI.png")
 
@@ -280,8 +422,7 @@ def main():
         unsafe_allow_html=True
     )
 
-    # Get list of countries with an added 'Global' option
-    countries = ['Global'] + sorted(data['country'].unique().tolist())
+    # List of countries with an added 'Global' option
     selected_country = st.sidebar.selectbox(
         'Select a country:',
         countries,
@@ -290,20 +431,17 @@ def main():
         on_change=update_selected_country
     )
 
-    # Filter company names based on selected country
-    if selected_country == 'Global':
-        company_names = data['company_name'].unique()
-    else:
-        company_names = data[data['country'] == selected_country]['company_name'].unique()
+    # Company names for the selected country
+    company_names = companies_by_country[selected_country]
 
     # Ensure selected company is valid
-    if st.session_state.selected_company not in company_names:
+    if st.session_state.selected_company not in company_positions[selected_country]:
         st.session_state.selected_company = company_names[0]
 
     selected_company = st.sidebar.selectbox(
         'Select a company:',
         company_names,
-        index=list(company_names).index(st.session_state.selected_company),
+        index=company_positions[selected_country].get(st.session_state.selected_company, 0),
         key='company_select',
         on_change=update_selected_company
     )
@@ -318,11 +456,8 @@ def main():
         unsafe_allow_html=True
     )
 
-    # Filter data based on selected company
-    filtered_data = filter_data_by_company(data, selected_company)
-
-    # Compute company information
-    company_info = compute_company_info(filtered_data)
+    # Look up the precomputed company information
+    company_info = build_summary()[selected_company]
 
     # Main page title with improved presentation
     st.markdown(
@@ -335,14 +470,14 @@ def main():
     )
 
     # Render the company info
-    render_company_info(company_info)
+    render_company_info(selected_company)
 
     # Render UI components
-    render_revenue_chart(filtered_data)
-    render_detailed_data_table(filtered_data)
+    render_revenue_chart(selected_company)
+    render_detailed_data_table(build_detailed_table(selected_company))
     
     # Render other companies from the same country
-    render_other_companies(data, company_info['Country'], company_info['Name'])
+    render_other_companies(companies_by_country.get(company_info['Country'], []), company_info['Country'], company_info['Name'], selected_country)
 
 if __name__ == "__main__":
     main()